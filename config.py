@@ -19,7 +19,11 @@ TRANSCODE_TEMP_PATH = "/tmp/transcoding/"
 HANDBRAKE_PRESET_FILE = "AV1_MKV_Stereo.json"
 HANDBRAKE_PRESET_NAME = "AV1_MKV_Stereo"
 
-# Path to the state file for tracking inspected files
+# SQLite database tracking inspected files (path, mtime, size, codec)
+STATE_DB_PATH = "~/.cache/transcode_watchdog.db"
+
+# Legacy plain-text state log; imported into STATE_DB_PATH once if present,
+# then renamed to <name>.imported
 INSPECTED_FILES_LOG = "inspected_files.log"
 
 # --- Transcoding Rules ---
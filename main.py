@@ -1,12 +1,23 @@
 import os
 import sys
 import json
+import argparse
+import atexit
+import importlib.util
 import shlex
 import logging
+import queue
+import re
 import subprocess
 import shutil
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Optional, List
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple, NamedTuple
 
 try:
     # When executed as a package: python -m transcode_watchdog.main
@@ -16,6 +27,7 @@ try:
         HANDBRAKE_PRESET_FILE,
         HANDBRAKE_PRESET_NAME,
         INSPECTED_FILES_LOG,
+        STATE_DB_PATH,
         MAX_FILE_SIZE_GB,
         TARGET_CODEC,
         VIDEO_EXTENSIONS,
@@ -28,11 +40,29 @@ except Exception:
         HANDBRAKE_PRESET_FILE,
         HANDBRAKE_PRESET_NAME,
         INSPECTED_FILES_LOG,
+        STATE_DB_PATH,
         MAX_FILE_SIZE_GB,
         TARGET_CODEC,
         VIDEO_EXTENSIONS,
     )
 
+# Config-derived constants, computed once rather than per inspected file
+SIZE_LIMIT_BYTES = int(MAX_FILE_SIZE_GB * (1024 ** 3))
+
+try:
+    # Optional: parses straight from bytes in C, no decode copy
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", errors="replace")
+    return json.loads(data)
+
 
 def ensure_dir(path: str) -> None:
     if not os.path.exists(path):
@@ -70,51 +100,138 @@ def resolve_path(base_dir: str, path: str) -> str:
     return os.path.join(base_dir, path)
 
 
-def load_inspected_files(log_path: str) -> set:
-    if not os.path.exists(log_path):
-        return set()
-    inspected = set()
-    with open(log_path, "r", encoding="utf-8") as f:
-        for line in f:
-            p = line.strip()
-            if p:
-                inspected.add(p)
-    return inspected
+# Commit state inserts in batches so a large scan doesn't fsync per file
+STATE_COMMIT_INTERVAL = 100
+
 
+def init_state_db(db_path: str) -> sqlite3.Connection:
+    ensure_dir(os.path.dirname(db_path))
+    # Handed from the inspection phase to the publisher thread; never used
+    # from two threads at once
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS inspected ("
+        "path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, codec TEXT)"
+    )
+    conn.commit()
+    return conn
 
-def append_inspected_file(log_path: str, file_path: str) -> None:
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(file_path + "\n")
+
+def import_inspected_log(conn: sqlite3.Connection, log_path: str) -> int:
+    # One-time migration from the old plain-text state log into an empty DB.
+    # The log is renamed to <log>.imported afterwards so it is never re-read
+    if not os.path.exists(log_path):
+        return 0
+    if conn.execute("SELECT 1 FROM inspected LIMIT 1").fetchone() is not None:
+        # DB already holds state; the log has nothing to add
+        os.replace(log_path, log_path + ".imported")
+        return 0
+    rows = []
+    for line in Path(log_path).read_text(encoding="utf-8").splitlines():
+        p = line.strip()
+        if not p:
+            continue
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        rows.append((p, st.st_mtime_ns, st.st_size, None))
+    mark_inspected_many(conn, rows)
+    conn.commit()
+    # Only retire the log once its rows are committed
+    os.replace(log_path, log_path + ".imported")
+    return len(rows)
+
+
+def is_inspected(conn: sqlite3.Connection, path: str, mtime: int, size: int) -> bool:
+    # Entries only count while the file is unchanged; a rewritten file is re-inspected
+    row = conn.execute(
+        "SELECT mtime, size FROM inspected WHERE path = ?", (path,)
+    ).fetchone()
+    return row is not None and row[0] == mtime and row[1] == size
+
+
+def mark_inspected(
+    conn: sqlite3.Connection, path: str, mtime: int, size: int, codec: Optional[str]
+) -> None:
+    mark_inspected_many(conn, [(path, mtime, size, codec)])
+
+
+def mark_inspected_many(
+    conn: sqlite3.Connection, rows: List[Tuple[str, int, int, Optional[str]]]
+) -> None:
+    # rows are (path, mtime, size, codec); one executemany per batch
+    conn.executemany(
+        "INSERT OR REPLACE INTO inspected (path, mtime, size, codec) VALUES (?, ?, ?, ?)",
+        rows,
+    )
 
 
 def verify_dependencies(logger: logging.Logger) -> bool:
-    required = ["ffprobe", "HandBrakeCLI", "rsync"]
+    required = ["ffprobe", "HandBrakeCLI"]
     missing = [cmd for cmd in required if shutil.which(cmd) is None]
     if missing:
         logger.critical(f"Missing required tools: {', '.join(missing)}")
         logger.critical("Ensure they are installed and available in PATH.")
         return False
-    logger.info("All required CLI tools found: ffprobe, HandBrakeCLI, rsync")
+    logger.info("All required CLI tools found: ffprobe, HandBrakeCLI")
     return True
 
 
 def scan_media_files(directories: list, extensions: tuple):
+    # Explicit stack over os.scandir: DirEntry type info comes from getdents,
+    # so no extra stat per entry (os.walk re-stats on NFS)
+    # One case-insensitive, anchored regex: matching runs in C with no
+    # per-name lowercase copy
+    ext_re = re.compile(
+        r"\.(?:" + "|".join(re.escape(e.lstrip(".")) for e in extensions) + r")\Z",
+        re.IGNORECASE,
+    )
     for directory in directories:
-        for root, _dirs, files in os.walk(directory):
-            for name in files:
-                if name.lower().endswith(extensions):
-                    yield os.path.join(root, name)
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                                continue
+                        except OSError:
+                            continue
+                        if ext_re.search(entry.name):
+                            # Size comes along with discovery so inspection can
+                            # decide on it without probing
+                            try:
+                                entry_stat = entry.stat()
+                            except OSError:
+                                entry_stat = None
+                            yield entry.path, entry_stat
+            except OSError:
+                # Unreadable subtree (permissions, stale NFS handle); keep walking
+                continue
 
 
-def run_cmd(logger: logging.Logger, cmd: list, check: bool = False) -> subprocess.CompletedProcess:
+def run_cmd(
+    logger: logging.Logger, cmd: list, check: bool = False, capture: bool = True
+) -> subprocess.CompletedProcess:
+    # capture=False discards stdout (e.g. HandBrakeCLI progress lines) instead
+    # of buffering it all in memory; stderr is kept for failure reports
     logger.info(f"Running: {' '.join(shlex.quote(c) for c in cmd)}")
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
     if result.returncode != 0:
         logger.warning(
             "Command failed (rc=%s): %s\nSTDOUT: %s\nSTDERR: %s",
             result.returncode,
             " ".join(shlex.quote(c) for c in cmd),
-            result.stdout.decode(errors="replace"),
+            result.stdout.decode(errors="replace") if capture else "<discarded>",
             result.stderr.decode(errors="replace"),
         )
         if check:
@@ -122,72 +239,213 @@ def run_cmd(logger: logging.Logger, cmd: list, check: bool = False) -> subproces
     return result
 
 
+# Long-lived probe worker: imports PyAV (libavformat) once and answers one
+# JSON line per path, shaped like ffprobe's -show_streams/-show_format output.
+_PROBE_WORKER_SRC = r"""
+import json
+import os
+import sys
+
+import av
+
+for line in sys.stdin:
+    path = line.rstrip("\n")
+    try:
+        with av.open(path) as container:
+            streams = []
+            for stream in container.streams:
+                # codec_context.name is the decoder (e.g. "libdav1d"); the
+                # codec's canonical_name matches ffprobe's codec_name ("av1")
+                ctx = getattr(stream, "codec_context", None)
+                codec = getattr(ctx, "codec", None)
+                streams.append(
+                    {
+                        "codec_type": stream.type,
+                        "codec_name": getattr(codec, "canonical_name", None),
+                    }
+                )
+            duration = container.duration / av.time_base if container.duration else 0.0
+        out = {
+            "streams": streams,
+            "format": {"duration": str(duration), "size": str(os.path.getsize(path))},
+        }
+    except Exception:
+        out = None
+    sys.stdout.write(json.dumps(out) + "\n")
+    sys.stdout.flush()
+"""
+
+
+class ProbeWorker:
+    def __init__(self) -> None:
+        env = dict(os.environ, PYTHONIOENCODING="utf-8:surrogateescape")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", _PROBE_WORKER_SRC],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="utf-8",
+            errors="surrogateescape",
+            env=env,
+        )
+        # One request/response in flight at a time on the shared pipes
+        self.lock = threading.Lock()
+
+    def probe(self, path: str) -> Optional[dict]:
+        with self.lock:
+            self.proc.stdin.write(path + "\n")
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        if not line:
+            raise OSError("probe worker exited")
+        return json_loads(line)
+
+    def close(self) -> None:
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+
+
+_probe_worker: Optional[ProbeWorker] = None
+_probe_worker_disabled = importlib.util.find_spec("av") is None
+_probe_worker_init_lock = threading.Lock()
+
+
+def get_probe_worker() -> Optional[ProbeWorker]:
+    global _probe_worker, _probe_worker_disabled
+    if _probe_worker_disabled:
+        return None
+    with _probe_worker_init_lock:
+        if _probe_worker is None and not _probe_worker_disabled:
+            try:
+                _probe_worker = ProbeWorker()
+                atexit.register(_probe_worker.close)
+            except OSError:
+                _probe_worker_disabled = True
+        return _probe_worker
+
+
+def disable_probe_worker() -> None:
+    global _probe_worker, _probe_worker_disabled
+    with _probe_worker_init_lock:
+        _probe_worker_disabled = True
+        if _probe_worker is not None:
+            _probe_worker.close()
+            _probe_worker = None
+
+
 def ffprobe_json(logger: logging.Logger, path: str) -> Optional[dict]:
+    worker = None if "\n" in path else get_probe_worker()
+    if worker is not None:
+        logger.info(f"Probing (PyAV worker): {path}")
+        try:
+            return worker.probe(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Probe worker unavailable ({e}); falling back to ffprobe")
+            disable_probe_worker()
+
     cmd = [
         "ffprobe",
         "-v",
         "quiet",
+        "-threads",
+        "0",
         "-print_format",
         "json",
-        "-show_format",
-        "-show_streams",
+        # Only the fields inspect_file/verify_transcode read; full tag and
+        # disposition dumps are most of ffprobe's output otherwise
+        "-show_entries",
+        "stream=codec_type,codec_name:format=duration,size",
         path,
     ]
     res = run_cmd(logger, cmd)
     if res.returncode != 0:
         return None
     try:
-        return json.loads(res.stdout.decode("utf-8", errors="replace"))
-    except json.JSONDecodeError:
+        return json_loads(res.stdout)
+    except ValueError:
+        return None
+
+
+def get_format_size(info: Optional[dict]) -> Optional[int]:
+    try:
+        return int((info or {}).get("format", {})["size"])
+    except (KeyError, TypeError, ValueError):
         return None
 
 
-def inspect_file(logger: logging.Logger, file_path: str, inspected_log_path: str) -> bool:
+def get_video_codec(info: Optional[dict]) -> Optional[str]:
+    for stream in (info or {}).get("streams", []):
+        if stream.get("codec_type") == "video":
+            return stream.get("codec_name")
+    return None
+
+
+def inspect_file(logger: logging.Logger, file_path: str) -> Tuple[bool, Optional[dict]]:
     info = ffprobe_json(logger, file_path)
     if not info:
         logger.info(f"Inspection failed to read metadata; queueing for transcode: {file_path}")
-        return True
+        return True, None
 
-    streams = info.get("streams", [])
-    fmt = info.get("format", {})
-    video_codec = None
-    for stream in streams:
-        if stream.get("codec_type") == "video":
-            video_codec = stream.get("codec_name")
-            break
+    video_codec = get_video_codec(info)
+    size_bytes = get_format_size(info) or 0
 
-    try:
-        size_bytes = int(fmt.get("size", 0))
-    except (TypeError, ValueError):
-        size_bytes = 0
-
-    size_limit_bytes = int(MAX_FILE_SIZE_GB * (1024 ** 3))
-    if (video_codec == TARGET_CODEC) and (size_bytes < size_limit_bytes):
+    if (video_codec == TARGET_CODEC) and (size_bytes < SIZE_LIMIT_BYTES):
         logger.info(
-            f"PASS: {file_path} (codec={video_codec}, size={size_bytes} < {size_limit_bytes})"
+            f"PASS: {file_path} (codec={video_codec}, size={size_bytes} < {SIZE_LIMIT_BYTES})"
         )
-        append_inspected_file(inspected_log_path, file_path)
-        return False
+        return False, info
 
     reasons = []
     if video_codec != TARGET_CODEC:
         reasons.append(f"codec is {video_codec}")
-    if size_bytes >= size_limit_bytes:
+    if size_bytes >= SIZE_LIMIT_BYTES:
         reasons.append("file size exceeds limit")
     logger.info(f"QUEUE: {file_path} (reasons: {', '.join(reasons) or 'unknown'})")
-    return True
+    return True, info
+
+
+def init_inspect_worker(base_dir: str) -> None:
+    global _probe_worker, _probe_worker_disabled
+    # Pool processes log through the same handlers as the parent
+    setup_logging(base_dir)
+    # Each pool process probes one file at a time, so a PyAV worker per child
+    # would only double the process count and add an IPC hop; probe with
+    # ffprobe directly. The ProbeWorker stays for the parent's encoder threads.
+    # (Drop rather than close any handle inherited via fork: it's the parent's.)
+    _probe_worker = None
+    _probe_worker_disabled = True
 
 
-def verify_transcode(logger: logging.Logger, original_path: str, new_path: str) -> bool:
-    # Health check
-    health = run_cmd(logger, ["ffprobe", "-v", "error", "-hide_banner", new_path])
-    if health.returncode != 0:
+def inspect_file_worker(file_path: str) -> Tuple[str, bool, Optional[dict]]:
+    # Runs in a ProcessPoolExecutor child, so it takes no logger and returns
+    # everything the parent needs to record the result
+    logger = logging.getLogger("transcode_watchdog")
+    try:
+        needs_transcode, info = inspect_file(logger, file_path)
+    except Exception as e:
+        logger.error(f"Inspection error for {file_path}: {e}")
+        needs_transcode, info = True, None
+    return file_path, needs_transcode, info
+
+
+def verify_transcode(
+    logger: logging.Logger,
+    original_info: Optional[dict],
+    new_info: Optional[dict],
+    new_path: str,
+) -> bool:
+    # The single probe of the new file doubles as the health check: a failed
+    # probe or missing streams/format means the container is unreadable
+    new = new_info
+    if not new or not new.get("streams") or not new.get("format"):
         logger.error(f"Health check failed for {new_path}")
         return False
 
-    orig = ffprobe_json(logger, original_path)
-    new = ffprobe_json(logger, new_path)
-    if not orig or not new:
+    orig = original_info
+    if not orig:
         logger.error("Failed to read metadata for verification")
         return False
 
@@ -198,9 +456,16 @@ def verify_transcode(logger: logging.Logger, original_path: str, new_path: str)
             duration = float(fmt.get("duration", 0))
         except (TypeError, ValueError):
             duration = 0.0
-        v = sum(1 for s in streams if s.get("codec_type") == "video")
-        a = sum(1 for s in streams if s.get("codec_type") == "audio")
-        sub = sum(1 for s in streams if s.get("codec_type") == "subtitle")
+        # Single pass; MKVs can carry hundreds of subtitle/attachment streams
+        v = a = sub = 0
+        for s in streams:
+            codec_type = s.get("codec_type")
+            if codec_type == "video":
+                v += 1
+            elif codec_type == "audio":
+                a += 1
+            elif codec_type == "subtitle":
+                sub += 1
         return duration, v, a, sub
 
     d1, v1, a1, s1 = extract_meta(orig)
@@ -222,45 +487,345 @@ def verify_transcode(logger: logging.Logger, original_path: str, new_path: str)
     return True
 
 
+def fsync_path(path: str) -> None:
+    # Works for files and directories; O_RDONLY is enough for fsync
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def safe_replace(logger: logging.Logger, source_path: str, new_local_path: str) -> bool:
     source_dir = os.path.dirname(source_path)
     source_filename = os.path.basename(source_path)
+    # Same directory as the original, so the final os.replace never crosses devices
     temp_remote_path = os.path.join(source_dir, f"{source_filename}.tmp")
-    old_remote_path = os.path.join(source_dir, f"{source_filename}.old")
 
+    # Step 6a: copy new file to temp path on remote. The media dirs are local
+    # mounts, so copyfile (copy_file_range/sendfile on Linux) beats rsync's
+    # delta transfer into a file that doesn't exist yet.
+    logger.info(f"Copying: {new_local_path} -> {temp_remote_path}")
     try:
-        # Step 6a: rsync new file to temp path on remote
-        rsync_cmd = [
-            "rsync",
-            "-avh",
-            "--progress",
-            new_local_path,
-            temp_remote_path,
-        ]
-        res = run_cmd(logger, rsync_cmd)
-        if res.returncode != 0:
-            logger.error("rsync to temp failed")
-            return False
-
-        # Step 6b and 6c: atomic swap
-        os.rename(source_path, old_remote_path)
-        os.rename(temp_remote_path, source_path)
-
-        # Step 6d: remove old
-        os.remove(old_remote_path)
-        return True
-    except Exception as e:
+        shutil.copyfile(new_local_path, temp_remote_path)
+        # Data must be durable before the rename can replace the original
+        fsync_path(temp_remote_path)
+        # Pages are clean after the fsync, so DONTNEED can actually evict this
+        # freshly written copy instead of letting it crowd out the cache
+        drop_page_cache(temp_remote_path)
+    except OSError as e:
+        logger.error(f"Copy to temp failed: {e}")
+        remove_quietly(temp_remote_path)
+        return False
+
+    # Step 6b: atomic swap. os.replace overwrites the original in one rename,
+    # so there is no window without a file at source_path and no .old to clean
+    try:
+        os.replace(temp_remote_path, source_path)
+    except OSError as e:
         logger.critical(f"Safe replace failed: {e}")
-        # Attempt best-effort rollback
-        try:
-            if os.path.exists(temp_remote_path) and not os.path.exists(source_path):
-                os.rename(temp_remote_path, source_path)
-        except Exception:
-            pass
+        remove_quietly(temp_remote_path)
         return False
 
+    # Step 6c: persist the rename
+    try:
+        fsync_path(source_dir)
+    except OSError as e:
+        logger.warning(f"Could not fsync {source_dir}: {e}")
+    return True
+
+
+def drop_page_cache(path: str) -> None:
+    # posix_fadvise(DONTNEED) is only a hint and isn't available on macOS
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class TranscodeJob(NamedTuple):
+    source_path: str
+    # Same as source_path unless the source was staged into TRANSCODE_TEMP_PATH
+    local_source_path: str
+    local_output_path: str
+    staged: bool
+    # Video codec of the verified output, recorded in state once published
+    output_codec: Optional[str] = None
+
+
+def remove_quietly(path: str) -> None:
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except Exception:
+        pass
+
+
+def cleanup_job(job: TranscodeJob) -> None:
+    # Never remove local_source_path when it is the original
+    if job.staged:
+        remove_quietly(job.local_source_path)
+    remove_quietly(job.local_output_path)
+
+
+def make_job(source_path: str, stage_locally: bool) -> TranscodeJob:
+    source_name = os.path.basename(source_path)
+    name_no_ext, _ext = os.path.splitext(source_name)
+    # Jobs overlap in the temp dir, so keep same-named sources from colliding
+    prefix = uuid.uuid4().hex[:8]
+    if stage_locally:
+        local_source_path = os.path.join(TRANSCODE_TEMP_PATH, f"{prefix}_{source_name}")
+    else:
+        local_source_path = source_path
+    return TranscodeJob(
+        source_path=source_path,
+        local_source_path=local_source_path,
+        local_output_path=os.path.join(TRANSCODE_TEMP_PATH, f"{prefix}_{name_no_ext}.av1.mkv"),
+        staged=stage_locally,
+    )
+
+
+def stage_source(
+    logger: logging.Logger, source_path: str, stage_locally: bool
+) -> Optional[TranscodeJob]:
+    job = make_job(source_path, stage_locally)
+    if not stage_locally:
+        # HandBrakeCLI reads the source straight from the media mount
+        return job
+    # Copy to local temp
+    logger.info(f"Copying: {source_path} -> {job.local_source_path}")
+    try:
+        shutil.copyfile(source_path, job.local_source_path)
+    except OSError as e:
+        logger.error(f"Failed to copy source to local temp: {source_path} ({e})")
+        cleanup_job(job)
+        return None
+    return job
+
+
+def transcode_and_verify(
+    logger: logging.Logger,
+    preset_path: str,
+    job: TranscodeJob,
+    original_info: Optional[dict],
+) -> Optional[TranscodeJob]:
+    # Returns the job with output_codec filled in, or None if it was dropped
+
+    # Transcode with HandBrakeCLI
+    hb_cmd = [
+        "HandBrakeCLI",
+        "--preset-import-file",
+        preset_path,
+        "-i",
+        job.local_source_path,
+        "-o",
+        job.local_output_path,
+        "--preset",
+        HANDBRAKE_PRESET_NAME,
+    ]
+    hb_res = run_cmd(logger, hb_cmd, capture=False)
+    if hb_res.returncode != 0 or not os.path.exists(job.local_output_path):
+        logger.error(f"Transcode failed for {job.source_path}")
+        cleanup_job(job)
+        return None
+
+    # Verify integrity from one probe of the new file; probe the source only
+    # if inspection couldn't
+    if not original_info:
+        original_info = ffprobe_json(logger, job.local_source_path)
+    new_info = ffprobe_json(logger, job.local_output_path)
+    if not verify_transcode(logger, original_info, new_info, job.local_output_path):
+        logger.error("Verification failed; deleting transcoded file")
+        cleanup_job(job)
+        return None
+    drop_page_cache(job.local_source_path)
+
+    # Compare sizes; format.size from the probes avoids another stat round-trip
+    try:
+        original_size = get_format_size(original_info)
+        if original_size is None:
+            original_size = os.path.getsize(job.local_source_path)
+        new_size = get_format_size(new_info)
+        if new_size is None:
+            new_size = os.path.getsize(job.local_output_path)
+    except OSError as e:
+        logger.error(f"Failed to stat files: {e}")
+        cleanup_job(job)
+        return None
+
+    if new_size >= original_size:
+        logger.info(
+            f"Not space-efficient (new {new_size} >= orig {original_size}); skipping replace"
+        )
+        cleanup_job(job)
+        return None
+    return job._replace(output_codec=get_video_codec(new_info))
+
+
+def publish_transcode(logger: logging.Logger, conn: sqlite3.Connection, job: TranscodeJob) -> None:
+    # Safe replace on remote
+    if not safe_replace(logger, job.source_path, job.local_output_path):
+        logger.error("Safe replace failed; leaving original untouched")
+        cleanup_job(job)
+        return
+
+    # Cleanup local temp files
+    cleanup_job(job)
+
+    # Mark the replaced file as inspected under its new mtime/size
+    new_stat = os.stat(job.source_path)
+    mark_inspected(
+        conn, job.source_path, new_stat.st_mtime_ns, new_stat.st_size, job.output_codec
+    )
+    conn.commit()
+    logger.info(f"SUCCESS: Replaced {job.source_path}")
+
+
+# How often blocked pipeline stages wake up to check for an abort
+PIPELINE_POLL_SECONDS = 0.5
+
+
+def put_unless_stopped(
+    q: "queue.Queue[Optional[TranscodeJob]]",
+    item: Optional[TranscodeJob],
+    stop_event: threading.Event,
+) -> bool:
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=PIPELINE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_unless_stopped(
+    q: "queue.Queue[Optional[TranscodeJob]]", stop_event: threading.Event
+) -> Optional[TranscodeJob]:
+    # None means end of queue or abort; callers stop either way
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=PIPELINE_POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return None
+
+
+def drain_jobs(q: "queue.Queue[Optional[TranscodeJob]]") -> None:
+    while True:
+        try:
+            job = q.get_nowait()
+        except queue.Empty:
+            return
+        if job is not None:
+            cleanup_job(job)
+
+
+def stage_worker(
+    logger: logging.Logger,
+    transcode_queue: List[str],
+    stage_locally: bool,
+    staged_q: "queue.Queue[Optional[TranscodeJob]]",
+    stop_event: threading.Event,
+) -> None:
+    try:
+        for source_path in transcode_queue:
+            if stop_event.is_set():
+                return
+            try:
+                job = stage_source(logger, source_path, stage_locally)
+            except Exception as e:
+                logger.exception(f"Unhandled error staging {source_path}: {e}")
+                continue
+            if job is not None and not put_unless_stopped(staged_q, job, stop_event):
+                cleanup_job(job)
+    finally:
+        put_unless_stopped(staged_q, None, stop_event)
+
+
+def encode_worker(
+    logger: logging.Logger,
+    preset_path: str,
+    probe_cache: Dict[str, dict],
+    staged_q: "queue.Queue[Optional[TranscodeJob]]",
+    done_q: "queue.Queue[Optional[TranscodeJob]]",
+    stop_event: threading.Event,
+) -> None:
+    while True:
+        job = get_unless_stopped(staged_q, stop_event)
+        if job is None:
+            # Pass the end marker on to the other encoders
+            put_unless_stopped(staged_q, None, stop_event)
+            return
+        if stop_event.is_set():
+            cleanup_job(job)
+            return
+        try:
+            original_info = probe_cache.pop(job.source_path, None)
+            verified_job = transcode_and_verify(logger, preset_path, job, original_info)
+            # An abort during a long encode must not hand the result on
+            if verified_job is not None and not put_unless_stopped(
+                done_q, verified_job, stop_event
+            ):
+                cleanup_job(verified_job)
+        except Exception as e:
+            logger.exception(f"Unhandled error processing {job.source_path}: {e}")
+            cleanup_job(job)
+
+
+def publish_worker(
+    logger: logging.Logger,
+    conn: sqlite3.Connection,
+    done_q: "queue.Queue[Optional[TranscodeJob]]",
+    stop_event: threading.Event,
+) -> None:
+    while True:
+        job = get_unless_stopped(done_q, stop_event)
+        if job is None:
+            return
+        if stop_event.is_set():
+            # Never replace originals after an abort
+            cleanup_job(job)
+            return
+        try:
+            publish_transcode(logger, conn, job)
+        except Exception as e:
+            logger.exception(f"Unhandled error processing {job.source_path}: {e}")
+            cleanup_job(job)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Jellyfin AV1 Transcoding Watchdog")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        # The bundled preset is software SVT-AV1, which already uses every
+        # core; parallel encodes only pay off for HW encoders or short files
+        default=1,
+        help="number of HandBrakeCLI encodes to run in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--stage-locally",
+        action="store_true",
+        help="copy each source into TRANSCODE_TEMP_PATH before encoding "
+        "instead of reading it from the media mount",
+    )
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
 
 def main():
+    args = parse_args()
     base_dir = os.path.dirname(os.path.abspath(__file__))
     logger = setup_logging(base_dir)
     logger.info("Starting Jellyfin AV1 Transcoding Watchdog")
@@ -271,12 +836,17 @@ def main():
     # Resolve paths possibly relative to repo
     preset_path = resolve_path(base_dir, HANDBRAKE_PRESET_FILE)
     inspected_log_path = resolve_path(base_dir, INSPECTED_FILES_LOG)
+    state_db_path = resolve_path(base_dir, os.path.expanduser(STATE_DB_PATH))
 
     ensure_dir(os.path.expanduser(TRANSCODE_TEMP_PATH))
 
     # Load state
-    inspected_files = load_inspected_files(inspected_log_path)
-    logger.info(f"Loaded {len(inspected_files)} previously inspected files")
+    conn = init_state_db(state_db_path)
+    imported = import_inspected_log(conn, inspected_log_path)
+    if imported:
+        logger.info(f"Imported {imported} entries from {inspected_log_path}")
+    inspected_count = conn.execute("SELECT COUNT(*) FROM inspected").fetchone()[0]
+    logger.info(f"Loaded {inspected_count} previously inspected files")
 
     # Prepare and log media directories
     expanded_media_dirs: List[str] = []
@@ -293,124 +863,131 @@ def main():
 
     # Scan and inspect
     transcode_queue: List[str] = []
+    # ffprobe results from inspection, reused as the "original" side of verification
+    probe_cache: Dict[str, dict] = {}
     discovered_count = 0
-    for media_path in scan_media_files(expanded_media_dirs, VIDEO_EXTENSIONS):
+    pending: List[str] = []
+    pending_stats: Dict[str, Optional[os.stat_result]] = {}
+    for media_path, media_stat in scan_media_files(expanded_media_dirs, VIDEO_EXTENSIONS):
         discovered_count += 1
-        if media_path in inspected_files:
+        if media_stat is not None and is_inspected(
+            conn, media_path, media_stat.st_mtime_ns, media_stat.st_size
+        ):
             logger.info(f"SKIP inspected: {media_path}")
             continue
-        try:
-            needs_transcode = inspect_file(logger, media_path, inspected_log_path)
-        except Exception as e:
-            logger.error(f"Inspection error for {media_path}: {e}")
-            needs_transcode = True
-        if needs_transcode:
+        # Passing needs codec == TARGET_CODEC *and* size under the limit, so a
+        # file at or over the limit is decided by its stat alone: queue it
+        # without spending a probe. With a tiny MAX_FILE_SIZE_GB this skips
+        # ffprobe for practically the whole library.
+        if media_stat is not None and media_stat.st_size >= SIZE_LIMIT_BYTES:
+            logger.info(f"QUEUE: {media_path} (reasons: file size exceeds limit)")
             transcode_queue.append(media_path)
+            continue
+        pending.append(media_path)
+        pending_stats[media_path] = media_stat
 
-    logger.info(f"Discovered {discovered_count} candidate files before filtering")
-    logger.info(f"Queue length: {len(transcode_queue)}")
-
-    # Process queue
-    for source_path in transcode_queue:
-        try:
-            source_name = os.path.basename(source_path)
-            local_source_path = os.path.join(TRANSCODE_TEMP_PATH, source_name)
-            name_no_ext, _ext = os.path.splitext(source_name)
-            local_output_path = os.path.join(TRANSCODE_TEMP_PATH, f"{name_no_ext}.av1.mkv")
-
-            # Copy to local temp
-            rsync_cmd = [
-                "rsync",
-                "-avh",
-                "--progress",
-                source_path,
-                local_source_path,
-            ]
-            res = run_cmd(logger, rsync_cmd)
-            if res.returncode != 0:
-                logger.error(f"Failed to rsync source to local temp: {source_path}")
-                continue
-
-            # Transcode with HandBrakeCLI
-            hb_cmd = [
-                "HandBrakeCLI",
-                "--preset-import-file",
-                preset_path,
-                "-i",
-                local_source_path,
-                "-o",
-                local_output_path,
-                "--preset",
-                HANDBRAKE_PRESET_NAME,
-            ]
-            hb_res = run_cmd(logger, hb_cmd)
-            if hb_res.returncode != 0 or not os.path.exists(local_output_path):
-                logger.error(f"Transcode failed for {source_path}")
-                if os.path.exists(local_output_path):
-                    try:
-                        os.remove(local_output_path)
-                    except Exception:
-                        pass
-                continue
+    # Passed files are buffered and written in batches of STATE_COMMIT_INTERVAL
+    pending_marks: List[Tuple[str, int, int, Optional[str]]] = []
 
-            # Verify integrity
-            if not verify_transcode(logger, local_source_path, local_output_path):
-                logger.error("Verification failed; deleting transcoded file")
-                try:
-                    os.remove(local_output_path)
-                except Exception:
-                    pass
-                continue
+    def record_inspection(media_path: str, needs_transcode: bool, info: Optional[dict]) -> None:
+        media_stat = pending_stats.pop(media_path)
+        if needs_transcode:
+            transcode_queue.append(media_path)
+            if info:
+                probe_cache[media_path] = info
+        elif media_stat is not None:
+            pending_marks.append(
+                (
+                    media_path,
+                    media_stat.st_mtime_ns,
+                    media_stat.st_size,
+                    get_video_codec(info),
+                )
+            )
+            if len(pending_marks) >= STATE_COMMIT_INTERVAL:
+                mark_inspected_many(conn, pending_marks)
+                conn.commit()
+                pending_marks.clear()
 
-            # Compare sizes
+    try:
+        if pending:
             try:
-                original_size = os.path.getsize(local_source_path)
-                new_size = os.path.getsize(local_output_path)
-            except OSError as e:
-                logger.error(f"Failed to stat files: {e}")
-                try:
-                    os.remove(local_output_path)
-                except Exception:
-                    pass
-                continue
-
-            if new_size >= original_size:
-                logger.info(
-                    f"Not space-efficient (new {new_size} >= orig {original_size}); skipping replace"
+                # Inspect in separate processes: probing and JSON parsing run in
+                # parallel without contending for one interpreter's GIL
+                with ProcessPoolExecutor(
+                    max_workers=os.cpu_count(),
+                    initializer=init_inspect_worker,
+                    initargs=(base_dir,),
+                ) as executor:
+                    # Results come back here; state is written from this process only
+                    for result in executor.map(inspect_file_worker, pending, chunksize=16):
+                        record_inspection(*result)
+            except BrokenProcessPool as e:
+                # A pool process died (OOM kill, libav crash); whatever it hadn't
+                # reported is still in pending_stats, so inspect that here
+                remaining = list(pending_stats)
+                logger.error(
+                    f"Inspection pool failed ({e}); inspecting {len(remaining)} "
+                    "remaining files in-process"
                 )
-                try:
-                    os.remove(local_output_path)
-                except Exception:
-                    pass
-                continue
+                for media_path in remaining:
+                    record_inspection(*inspect_file_worker(media_path))
+    finally:
+        mark_inspected_many(conn, pending_marks)
+        conn.commit()
 
-            # Safe replace on remote
-            if not safe_replace(logger, source_path, local_output_path):
-                logger.error("Safe replace failed; leaving original untouched")
-                try:
-                    os.remove(local_output_path)
-                except Exception:
-                    pass
-                continue
-
-            # Cleanup local temp files
-            try:
-                if os.path.exists(local_source_path):
-                    os.remove(local_source_path)
-            except Exception:
-                pass
-            try:
-                if os.path.exists(local_output_path):
-                    os.remove(local_output_path)
-            except Exception:
-                pass
+    logger.info(f"Discovered {discovered_count} candidate files before filtering")
+    logger.info(f"Queue length: {len(transcode_queue)}")
 
-            # Mark original as inspected now that it has been replaced
-            append_inspected_file(inspected_log_path, source_path)
-            logger.info(f"SUCCESS: Replaced {source_path}")
+    # Process queue as a three-stage pipeline: the stager copies sources in
+    # (with --stage-locally) while --jobs encoder threads run HandBrakeCLI,
+    # and the publisher copies results back out. Bounded queues cap how many
+    # copies sit in TRANSCODE_TEMP_PATH.
+    staged_q: "queue.Queue[Optional[TranscodeJob]]" = queue.Queue(maxsize=args.jobs)
+    done_q: "queue.Queue[Optional[TranscodeJob]]" = queue.Queue(maxsize=args.jobs)
+    # Set on Ctrl-C so no stage starts new work or publishes after an abort
+    stop_event = threading.Event()
+    stager = threading.Thread(
+        target=stage_worker,
+        args=(logger, transcode_queue, args.stage_locally, staged_q, stop_event),
+        name="stager",
+    )
+    encoders = [
+        threading.Thread(
+            target=encode_worker,
+            args=(logger, preset_path, probe_cache, staged_q, done_q, stop_event),
+            name=f"encoder-{i}",
+        )
+        for i in range(args.jobs)
+    ]
+    publisher = threading.Thread(
+        target=publish_worker, args=(logger, conn, done_q, stop_event), name="publisher"
+    )
+    logger.info(f"Processing queue with {args.jobs} parallel encode job(s)")
+    stager.start()
+    for encoder in encoders:
+        encoder.start()
+    publisher.start()
 
-        except Exception as e:
-            logger.exception(f"Unhandled error processing {source_path}: {e}")
+    try:
+        stager.join()
+        for encoder in encoders:
+            encoder.join()
+        done_q.put(None)
+        publisher.join()
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; stopping the pipeline without replacing more files")
+        stop_event.set()
+        stager.join()
+        for encoder in encoders:
+            encoder.join()
+        publisher.join()
+        drain_jobs(staged_q)
+        drain_jobs(done_q)
+        conn.close()
+        raise
+
+    conn.close()
 
 
 if __name__ == "__main__":